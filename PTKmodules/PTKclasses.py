@@ -7,9 +7,39 @@ Copyright 2015 Ellis & Grant, Inc.
 License: Open Source (MIT License)
 """
 from reaper_python import *
-from PTKutils import dbg, userInputs
+from PTKutils import dbg, console, userInputs, parseOverrides, parseRamp
+from PTKlayout import computeLayout
+from PTKsegmap import Segment, SegmentMap
+from PTKexport import exportClips
+from bisect import bisect_left, bisect_right
+import json, os
 import time
 
+'''
+Undo state flags for RPR_Undo_EndBlock(). See the Reaper API docs.
+'''
+UNDO_STATE_TRACKCFG = 1  # track settings and all envelopes, including the
+                         # master track's tempo envelope, i.e. the tempo map
+UNDO_STATE_ITEMS = 4     # media items
+UNDO_STATE_MISCCFG = 8   # loop selection, markers, regions and ext state
+
+'''
+Names of the files in the project directory where change journals and the
+practice/source segment map are kept.  See ChangeJournal and
+PTKsegmap.SegmentMap.
+'''
+JOURNAL_FILENAME = "PracticeTrack.journal"
+SEGMENTS_FILENAME = "PracticeTrack.segments"
+
+'''
+Most runs kept in the journal file.  Older ones are dropped.
+'''
+JOURNAL_DEPTH = 20
+
+'''
+Directory in the project directory where exportClipLibrary() writes clips.
+'''
+CLIPS_DIRNAME = "PracticeClips"
 
 def run():
     """
@@ -21,13 +51,45 @@ def run():
     4.  Unselect media items (so we can select each one sequentially).
     5.  Start at the beginning time of the leftmost selected item.
     6.  Replicate each item with ndups copies after it.
-    7.  Enable UI updates and update the Arrange window.
+    7.  Copy the track's envelope points and the project markers and regions
+        to the moved and duplicated items.
+    8.  Enable UI updates and update the Arrange window.
+
+    The ramp parameter lists the tempo, in percent of the original, for the
+    original and each duplicate in turn, e.g. "70 85 100".  Copies beyond the
+    end of the list use the last value.
+
+    When the playlist parameter is non-zero, steps 2-7 are replaced by
+    creating a region playlist.  See RegionPlaylistBuilder.  The ramp doesn't
+    apply to playlists.
+
+    Everything changed is recorded in a ChangeJournal so that revert() can
+    put the project back. Where each copy came from in the source recording
+    is kept in the journal and written to SEGMENTS_FILENAME.  Playlist runs
+    don't move anything, so they remove SEGMENTS_FILENAME.  Returns the undo
+    state flags for the changes made, or None if nothing was changed.
 
     NOTE: This script will not work correctly unless the timebase is set to
     "time" for  items AND tempo time sig markers.  See the File: Project Settings
-    dialog to control these items.
+    dialog to control these items.  preflight() reports items and markers
+    with another timebase before anything is changed.  The project defaults
+    are only checked when the SWS extension is installed.
     """
-    uin = userInputs("Parameters", ndups=1, nbetween=1)
+    '''
+    Check the selection before asking for parameters or touching the
+    project.
+    '''
+    proj = 0  ## current project
+    problems, track = preflight(proj)
+    if problems:
+        report = "PracticeTrack can't process this selection:\n  " + \
+                 "\n  ".join(problems)
+        dbg(report)
+        console(report)
+        return
+
+    uin = userInputs("Parameters", ndups=1, nbetween=1, playlist=0,
+                     ramp="100")
     if uin is None:
         dbg("Cancelled")
         return
@@ -44,6 +106,14 @@ def run():
         ndups = uin.ndups
         nbetween = uin.nbetween
 
+    rates = parseRamp(uin.ramp)
+    if not rates:
+        dbg("Bad ramp {}. Use tempo percentages like 70 85 100".format(
+            uin.ramp))
+        return
+
+    journal = ChangeJournal(proj)
+
     '''
     Initialize a run timer so we can see how long various parts
     of the processing require.
@@ -59,7 +129,6 @@ def run():
     nsig = RPR_CountTempoTimeSigMarkers(0)
     dbg("{} time signatures in project".format(nsig))
     sigids = range(nsig)
-    proj = 0  ## current project
 
     siglist = []
     for sigid in sigids:
@@ -90,28 +159,39 @@ def run():
         item = MediaItemReplicator(proj, itemid, siglist)
         #item.dump()
         items.append(item)
-    
+
+    tmr("Finished setting up selected media item list.")    
+
     '''
-    Make a list of the Reaper MediaItem references for each item in
-    the user's selections.  
+    Read any per-item ndups and nbetween settings from the items' notes and
+    take names. Items without them use the values from the dialog.  The
+    dictionaries are keyed by the selected items' Reaper references.
     '''
-    selectediids = [item.iid for item in items]
+    overrides = readItemOverrides(items)
+    itemndups = {}
+    itemnbetween = {}
+    for item in items:
+        itemndups[item.iid] = overrides[item.iid].get("ndups", ndups)
+        itemnbetween[item.iid] = overrides[item.iid].get("nbetween", nbetween)
+    tmr("Finished reading item overrides.")
 
     '''
-    We now have a list of current MediaItemReplicator instances for each
-    selected media item.  We don't currently handle multiple tracks, so check
-    and continue only if all items are in the same track.
+    In playlist mode the items stay where they are. We only add regions and
+    the count-in tempo markers, then we're done.
     '''
-
-    tracks = [ RPR_GetMediaItem_Track(i.iid) for i in items ]
-    dbg(tracks)
-    if len(set(tracks)) != 1:
-        dbg("Usage Error: All selected items must be in the same track.")
-        return
-    else:
-        track = tracks[0] 
-
-    tmr("Finished setting up selected media item list.")    
+    if uin.playlist:
+        journal.recordExtState("PracticeTrack", "playlist")
+        RPR_PreventUIRefresh(1)
+        builder = RegionPlaylistBuilder(proj)
+        builder.build(items, itemndups, itemnbetween)
+        RPR_PreventUIRefresh(-1)
+        RPR_UpdateArrange()
+        journal.recordMarkers([], builder.createdregions)
+        journal.recordSigs([], builder.createdsigs)
+        journal.save()
+        writeSegmentMap([journal])
+        tmr("Playlist completed.")
+        return journal.undoflags()
 
     '''
     Now create a list of MediaItemReplicators for ALL items in the track. We'll
@@ -128,6 +208,23 @@ def run():
 
     tmr("Finished getting list of ALL media items.")
 
+    journal.recordItems(track, trackitems)
+
+    '''
+    Take a snapshot of the track's automation envelopes before anything
+    moves.  The points are written back at the new item positions after the
+    items have been replicated.
+    '''
+    envelopes = TrackEnvelopeReplicator(proj, track, trackitems)
+    tmr("Finished reading track envelopes.")
+
+    '''
+    Likewise for the project markers and regions, e.g. rehearsal letters and
+    lyrics.
+    '''
+    markers = ProjectMarkerReplicator(proj, trackitems)
+    tmr("Finished reading project markers.")
+
     '''
     We're ready to start moving and replicating items. Begin by freezing the 
     UI. It's not strictly necessary, but gives better performance.
@@ -150,32 +247,55 @@ def run():
     RPR_SelectAllMediaItems(0, False)
 
     '''
-    The variable endt represents the ending time position of the item just
-    processed. It may or may not include some outtime to finish on a measure
-    end.  The important thing is that it represents the earliest time allowed
-    for the start of the next item to be processed.
+    Compute the destination of every original, duplicate and count-in in one
+    pass.  Items to the left of the first selection get no duplicates.  No
+    item is placed left of where it is now.
     '''
-    endt = 0.0
+    layout = computeLayout([item.length for item in trackitems],
+                           [item.countInTime(itemnbetween.get(item.iid,
+                                                              nbetween))
+                                for item in trackitems],
+                           [item.outtime for item in trackitems],
+                           [itemndups.get(item.iid, 0) for item in trackitems],
+                           rates=rates,
+                           ramped=[item.iid in itemndups
+                                       for item in trackitems],
+                           positions=[item.pos for item in trackitems])
+    tmr("Finished computing layout.")
 
     '''
     Init a dictionary of tempo time sigs with time position as keys.
     '''
     incountsigd = {}
-    for item in trackitems:
+    for n, item in enumerate(trackitems):
         item.dump()
-        if item.iid in selectediids:
-            endt, _incountsigd = item.replicate(endt, 
-                                   ndups, 
-                                   nbetween=nbetween)
-        else:
-            endt, _incountsigd = item.replicate(endt, 
-                                   0, 
-                                   nbetween = nbetween)
-
-        incountsigd.update(_incountsigd)
+        incountsigd.update(item.replicate(layout.copies(n)))
 
     tmr("Finished item processing")
 
+    journal.recordDuplicates(track)
+
+    '''
+    Record the map between practice track and source recording times, from
+    where the copies actually went.
+    '''
+    segments = []
+    for n, item in enumerate(trackitems):
+        for copynum, ((incount, start, _), dest, rate) in enumerate(
+                zip(layout.copies(n), item.destinations, item.rates)):
+            segments.append(Segment(dest, dest + item.length / rate,
+                                    item.pos, copynum, incount + dest - start,
+                                    dest, rate))
+    journal.recordSegments(segments)
+
+    envelopes.replicate()
+    journal.recordEnvelopes(envelopes.rewritten)
+    tmr("Finished replicating track envelopes.")
+
+    markers.replicate()
+    journal.recordMarkers(markers.deleted, markers.created)
+    tmr("Finished replicating project markers.")
+
     '''
     Create the incount signatures. These are tempo time signature markers
     that start the count-in before each item. These could have been created
@@ -190,6 +310,7 @@ def run():
     for t in sigtimes:
         incountsigd[t].create()
 
+    journal.recordSigs(siglist, [incountsigd[t].timepos for t in sigtimes])
     tmr("Finished creating incount sigs.")
 
     # clean up the sigs
@@ -201,7 +322,293 @@ def run():
     RPR_PreventUIRefresh(-1)
     RPR_UpdateArrange()
 
+    journal.save()
+    writeSegmentMap([journal])
     tmr("Run completed.")
+    return journal.undoflags()
+
+
+def revert():
+    """
+    The toplevel function for PracticeTrackRevert.py.  Undoes the most recent
+    run() recorded in the project's change journal and removes it from the
+    journal.  The segment map of the run before it, if any, is put back.
+    Returns the undo state flags for the changes made, or None if nothing was
+    changed.
+    """
+    proj = 0  ## current project
+    journals = ChangeJournal.loadAll(proj)
+    if not journals:
+        console("PracticeTrack: nothing to revert.")
+        return
+    journal = journals[-1]
+    problems = journal.revert()
+    if problems:
+        '''
+        Earlier runs can only be reverted after this one, so the whole
+        journal is of no further use.
+        '''
+        ChangeJournal.saveAll(proj, [])
+        report = "PracticeTrack can't revert the last run:\n  " + \
+                 "\n  ".join(problems) + \
+                 "\nThe journal has been cleared. Use Edit Undo instead."
+        dbg(report)
+        console(report)
+        return
+    ChangeJournal.saveAll(proj, journals[:-1])
+    writeSegmentMap(journals[:-1])
+    return journal.undoflags()
+
+
+def exportClipLibrary():
+    """
+    The toplevel function for PracticeTrackExport.py.  Writes each selected
+    item as a standalone .wav file in CLIPS_DIRNAME: nbetween bars + intime
+    of metronome clicks at the item's tempo and meter to count in, then the
+    phrase, with a manifest of the timing of each clip.  nbetween comes from
+    the dialog or the item's own setting, as in run().  The project isn't
+    changed.
+
+    Take playrates are ignored. Phrases are sliced at the source's own rate.
+    """
+    proj = 0  ## current project
+    problems, _ = preflight(proj)
+    if problems:
+        report = "PracticeTrack can't export this selection:\n  " + \
+                 "\n  ".join(problems)
+        dbg(report)
+        console(report)
+        return
+
+    uin = userInputs("Export", nbetween=1, nthreads=4)
+    if uin is None:
+        dbg("Cancelled")
+        return
+    elif uin is False:
+        # Bad input
+        return
+    elif uin.nbetween < 0:
+        dbg("Can't have negative number of bars between items!")
+        return
+    elif uin.nthreads < 1:
+        dbg("Need at least one thread!")
+        return
+
+    tmr = RunTimer().message
+    tmr("Starting export ...")
+
+    siglist = [TempoTimeSigMarkerWrapper(proj, sigid)
+               for sigid in range(RPR_CountTempoTimeSigMarkers(proj))]
+    items = [MediaItemReplicator(proj, itemid, siglist)
+             for itemid in range(RPR_CountSelectedMediaItems(proj))]
+    items.sort(key=lambda item: item.pos)
+    overrides = readItemOverrides(items)
+
+    clips = []
+    for n, item in enumerate(items):
+        take = RPR_GetActiveTake(item.iid)
+        if not take:
+            dbg("Item at {} has no take. Skipped.".format(item.pos))
+            continue
+        source = RPR_GetMediaItemTake_Source(take)
+        sourcefile = RPR_GetMediaSourceFileName(source, "", 4096)[1]
+        nbetween = overrides[item.iid].get("nbetween", uin.nbetween)
+        insig, _, _ = item.findSigs()
+        clips.append({
+            "index" : n + 1,
+            "bar" : item.posbar,
+            "source" : sourcefile,
+            "sourceoffset" : RPR_GetMediaItemTakeInfo_Value(take,
+                                                            "D_STARTOFFS"),
+            "length" : item.length,
+            "countin" : item.countInTime(nbetween),
+            "countinbeats" : nbetween * item.poscml + item.posbeats,
+            "secondsperbeat" : item.secondsperbeat,
+            "beatsperbar" : item.poscml,
+            "projectpos" : item.pos,
+            "bpm" : insig.bpm,
+            "timesig_num" : insig.timesig_num,
+            "timesig_denom" : insig.timesig_denom,
+            })
+    tmr("Finished gathering {} clips.".format(len(clips)))
+
+    outdir = projectFile(CLIPS_DIRNAME)
+    try:
+        manifest = exportClips(clips, outdir, uin.nthreads)
+    except (IOError, OSError, ValueError) as e:
+        dbg("Export failed: {}".format(e))
+        console("PracticeTrack export failed: {}".format(e))
+        return
+    skipped = [entry for entry in manifest if "skipped" in entry]
+    for entry in skipped:
+        dbg("Phrase {} at bar {} skipped: {}".format(entry["index"],
+                                                     entry["bar"],
+                                                     entry["skipped"]))
+    tmr("Export completed.")
+    console("PracticeTrack exported {} clips to {}, {} skipped".format(
+            len(manifest) - len(skipped), outdir, len(skipped)))
+
+
+def projectFile(filename):
+    """ Return the path of filename in the current project's directory. """
+    projectpath = RPR_GetProjectPath("", 512)[0]
+    return os.path.join(projectpath, filename)
+
+
+def writeSegmentMap(journals):
+    """
+    Write SEGMENTS_FILENAME from the segments recorded by the last of
+    journals, oldest first.  Remove it if that run recorded none, as playlist
+    runs don't, or if there are no journals.
+    """
+    path = projectFile(SEGMENTS_FILENAME)
+    rows = journals[-1].record.get("segments") if journals else None
+    if rows:
+        SegmentMap([Segment(*row) for row in rows]).dump(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def preflight(proj):
+    """
+    Check the selected items, the other items in their track and the tempo
+    map for problems that would spoil the practice track.  Nothing in the
+    project is changed.
+
+    Item properties are read in a single pass and the interval checks are
+    done on the items sorted by position, so this takes milliseconds even for
+    large projects.
+
+    returns:
+        - (problems, track) where problems is a list of strings, one per
+          problem found, and track is the MediaTrack holding the selection.
+          problems is empty when all is well.
+    """
+    problems = []
+    track = None
+
+    if RPR_CountTempoTimeSigMarkers(proj) == 0:
+        problems.append("The project has no tempo/time signature markers. "
+                        "Tempo map the track first.")
+
+    nitems = RPR_CountSelectedMediaItems(proj)
+    if nitems == 0:
+        problems.append("No media items are selected.")
+        return problems, track
+
+    tracks = set()
+    for itemid in range(nitems):
+        iid = RPR_GetSelectedMediaItem(proj, itemid)
+        tracks.add(RPR_GetMediaItem_Track(iid))
+    if len(tracks) != 1:
+        problems.append("Selected items are on {} different tracks. All "
+                        "selected items must be in the same track.".format(
+                        len(tracks)))
+        return problems, track
+    track = tracks.pop()
+
+    '''
+    An item's timebase of -1 means use the track's, and a track's of -1
+    means use the project default.  The project settings can only be read
+    with the SWS extension.  Without it, items that use the project default
+    aren't checked.
+    '''
+    timebases = {1 : "beats (position, length, rate)",
+                 2 : "beats (position only)"}
+    trackmode = int(RPR_GetMediaTrackInfo_Value(track, "C_BEATATTACHMODE"))
+    projectmode = projectConfigInt("itemtimelock")
+    if projectmode is None:
+        dbg("Can't read the project timebase without SWS. Not checked.")
+
+    if projectConfigInt("tempoenvtimelock"):
+        problems.append("Tempo/time signature markers have timebase beats. "
+                        "Set the timebase for tempo/time signature envelope "
+                        "to time in File: Project Settings.")
+
+    '''
+    Read position, length, selection and timebase of every item in the
+    track in one pass.  Items are numbered from 1 in the messages, as they
+    appear in the track.
+    '''
+    spans = []
+    for titemid in range(RPR_CountTrackMediaItems(track)):
+        iid = RPR_GetTrackMediaItem(track, titemid)
+        pos = RPR_GetMediaItemInfo_Value(iid, "D_POSITION")
+        length = RPR_GetMediaItemInfo_Value(iid, "D_LENGTH")
+        selected = RPR_IsMediaItemSelected(iid)
+        spans.append((pos, pos + length, titemid + 1, selected))
+        if not selected:
+            continue
+        if length <= 0:
+            problems.append("Item {} at {:.3f}s has zero length.".format(
+                            titemid + 1, pos))
+        mode = int(RPR_GetMediaItemInfo_Value(iid, "C_BEATATTACHMODE"))
+        if mode < 0:
+            mode = trackmode
+        if mode < 0:
+            if projectmode in timebases:
+                problems.append("Item {} at {:.3f}s uses the project timebase "
+                                "{}. Set it to time in File: Project "
+                                "Settings.".format(titemid + 1, pos,
+                                                   timebases[projectmode]))
+        elif mode in timebases:
+            problems.append("Item {} at {:.3f}s has timebase {}. Set it to "
+                            "time.".format(titemid + 1, pos, timebases[mode]))
+
+    spans.sort()
+    for (pos0, end0, num0, _), (pos1, _, num1, _) in zip(spans, spans[1:]):
+        if pos1 < end0 - 1e-6:
+            problems.append("Items {} and {} overlap between {:.3f}s and "
+                            "{:.3f}s.".format(num0, num1, pos1, end0))
+
+    selected = [n for n, span in enumerate(spans) if span[3]]
+    for pos, _, num, isselected in spans[selected[0]:selected[-1] + 1]:
+        if not isselected:
+            problems.append("Item {} at {:.3f}s is not selected but lies "
+                            "between selected items. The selection must be "
+                            "contiguous.".format(num, pos))
+
+    return problems, track
+
+
+def projectConfigInt(name):
+    """
+    Return the value of the integer Reaper config variable name, e.g.
+    "itemtimelock", the project's default item timebase, or None if it can't
+    be read.  Needs SNM_GetIntConfigVar() from the SWS extension.
+    """
+    getter = (globals().get("RPR_SNM_GetIntConfigVar") or
+              globals().get("SNM_GetIntConfigVar"))
+    if getter is None:
+        return None
+    value = getter(name, -1)
+    return None if value < 0 else value
+
+
+def readItemOverrides(items):
+    """
+    Read per-item settings from the notes and active take name of each item
+    in one pass.  Settings are written as ndups=N and nbetween=N. Notes take
+    precedence over the take name.
+
+    args:
+        - items is a list of MediaItemReplicators.
+    returns:
+        - a dictionary of Maps keyed by item.iid. Each Map has an entry for
+          each setting found for that item.
+    """
+    overrides = {}
+    for item in items:
+        notes = RPR_GetSetMediaItemInfo_String(item.iid, "P_NOTES", "",
+                                               False)[3]
+        take = RPR_GetActiveTake(item.iid)
+        takename = RPR_GetTakeName(take) if take else ""
+        found = parseOverrides(takename, "ndups", "nbetween")
+        found.update(parseOverrides(notes, "ndups", "nbetween"))
+        if found:
+            dbg("Item at {} overrides {}".format(item.pos, dict(found)))
+        overrides[item.iid] = found
+    return overrides
 
 
 class TempoTimeSigMarkerWrapper(object):
@@ -411,6 +818,11 @@ class MediaItemReplicator(object):
         '''
         self.posbeats = retlist[0]
 
+        '''
+        Number of the bar where the item begins, counting from 1.
+        '''
+        self.posbar = retlist[3] + 1
+
         '''
         Measure length in beats, i.e., time signature numerator for the
         measure in which the item begins.
@@ -466,6 +878,13 @@ class MediaItemReplicator(object):
         '''
         self.tempotimesiglist = tempotimesiglist
 
+        '''
+        Start times and playback rates of the original and each duplicate.
+        Filled in by replicate().
+        '''
+        self.destinations = []
+        self.rates = []
+
         '''
         Compute 2 values used in spacing between items.  Intime is
         the bar time before the item starts.
@@ -473,13 +892,21 @@ class MediaItemReplicator(object):
         Unit for intime and outttime is seconds.
         '''
         intimebeats = self.posbeats
-        secondsperbeat = 60./self.posbpm
-        self.intime = secondsperbeat * intimebeats
+        self.secondsperbeat = 60./self.posbpm
+        self.intime = self.secondsperbeat * intimebeats
 
         outtimebeats = self.endcml - self.endbeats
         secondsperbeat = 60./self.endbpm
         self.outtime = outtimebeats * secondsperbeat
 
+    def countInTime(self, nbetween):
+        """
+        Return the seconds of count-in before a copy of the item at its
+        recorded tempo: nbetween bars at the tempo and meter where the item
+        begins, then intime.
+        """
+        return nbetween * self.poscml * self.secondsperbeat + self.intime
+
     def dump(self):
         """ Neatly print attributes """
         dbg("proj = {}".format(self.proj))
@@ -487,6 +914,7 @@ class MediaItemReplicator(object):
         dbg("pos = {}".format(self.pos))
         dbg("length = {}".format(self.length))
         dbg("posbeats = {}".format(self.posbeats))
+        dbg("posbar = {}".format(self.posbar))
         dbg("poscml = {}".format(self.poscml))
         dbg("poscdenom = {}".format(self.poscdenom))
         dbg("posbpm = {}".format(self.posbpm))
@@ -497,16 +925,47 @@ class MediaItemReplicator(object):
         dbg("intime = {}".format(self.intime))
         dbg("outtime = {}".format(self.outtime))
 
-    def replicate(self, t0, ndups, nbetween=0):
+    def findSigs(self):
+        """
+        Return (insig, outsig, itemsigs) where insig and outsig are the tempo
+        time sig markers in effect at the beginning and end of the item and
+        itemsigs is a list of the markers inside the item.
+        """
+        itemsigs = []
+        insig = outsig = self.tempotimesiglist[0] # earliest possible
+        for sig in self.tempotimesiglist:
+            if self.pos <= sig.timepos < (self.pos + self.length):
+                dbg("Sig {} is in this item".format(sig.ptidx))
+                itemsigs.append(sig)
+                #sig.dump()
+            if sig.timepos <= self.pos + .001:
+                insig = sig
+            if sig.timepos <= self.end:
+                outsig = sig
+        return insig, outsig, itemsigs
+
+    def replicate(self, copies):
         """
         Make 0 or more copies of an item and preserve the surrounding meter
         positions and tempi.
 
+        args:
+            - copies is a list of (incount, start, rate) tuples, one for the
+              original followed by one for each duplicate, as returned by
+              ItemLayout.copies().  See computeLayout() in PTKlayout.py.
+              incount and start are time positions.  A copy with a rate
+              other than 1.0 plays that much faster, with its length and
+              tempo time sig markers scaled to match.
+
         Details of what this method does:
 
-            Move item to t0 and follow it with ndups copies. Include outtime
-            after original and all copies.  Prepend nbetween full measures +
-            intime to all copies.
+            Move the original to the first start position and put a duplicate
+            at each of the others.  The gap between each incount and start
+            holds nbetween full measures + intime. The outtime after each
+            copy is already accounted for in the next incount.  An original
+            already right of its start position stays put and its copies keep
+            their spacing from it.  self.destinations records where the
+            copies actually went.
 
             Replicate all tempo time signature marker in original and copies.
             Make sure that the moved original begins with the correct tempo and
@@ -515,8 +974,8 @@ class MediaItemReplicator(object):
             The resulting sequence for each item looks like: betweentime intime
             orig outtime [ [ betweentime intime dup outtime] ... ]
 
-            Return t0 + sum of all time added such that the returned time
-            corresponds to the end of the last outtime.
+            Return a dictionary of deferred tempo time sig markers with time
+            positions as keys.
 
         """
 
@@ -526,16 +985,7 @@ class MediaItemReplicator(object):
         the marker for the sig in effect at the beginning of the item. The
         latter will be used for the lead-in count.
         '''
-
-        itemsigs = []
-        insig = self.tempotimesiglist[0] # earliest possible
-        for sig in self.tempotimesiglist:
-            if self.pos <= sig.timepos < (self.pos + self.length):
-                dbg("Sig {} is in this item".format(sig.ptidx))
-                itemsigs.append(sig)
-                #sig.dump()
-            if sig.timepos <= self.pos + .001:
-                insig = sig
+        insig, _, itemsigs = self.findSigs()
         incountsigd = {}
 
         #dbg("\nIncount sig info:")
@@ -545,82 +995,734 @@ class MediaItemReplicator(object):
         # select the item (so we can use ApplyNudge())
         RPR_SetMediaItemSelected(self.iid, True)
 
-        # Caculate destination time position
-        t = t0
-        dbg("Entering replicate() with t={}".format(t))
-        incountsigd[t] = (TempoTimeSigMarkerWrapper(self.proj, None,
-                timepos = t,
-                bpm = insig.bpm,
-                num = insig.timesig_num,
-                denom = insig.timesig_denom))
-
-
-        betweentime = nbetween * self.poscml * 60./self.posbpm
-        dbg("betweentime = {}".format(betweentime))
-        t += betweentime + self.intime
-
-        # Move the item if need be
-        if t > self.pos:
-            RPR_SetMediaItemInfo_Value(self.iid, "D_POSITION", t)
-            dbg('Item moved to {}'.format(t))
-
-        # copy the tempo time markers to the new location.
-        for sig in itemsigs:
-            newpos = t
-            incountsigd[t] = sig.clone(newpos - self.pos, deferred=True)
+        '''
+        Item length and take playrate at the original tempo.  If any copy
+        plays at another rate, every copy gets its rate set explicitly since
+        each duplicate starts out with the rate of the one before it.
+        '''
+        scaled = any(rate != 1.0 for (_, _, rate) in copies)
+        if scaled:
+            itemlength = RPR_GetMediaItemInfo_Value(self.iid, "D_LENGTH")
+            take = RPR_GetActiveTake(self.iid)
+            playrate = (RPR_GetMediaItemTakeInfo_Value(take, "D_PLAYRATE")
+                        if take else 1.0)
 
-        # Advance to end of item
-        t += self.length
-        t += self.outtime
+        '''
+        Remember where the original and each copy actually start, and their
+        rates, so that envelopes and other time based data can be relocated to
+        match.
+        '''
+        self.destinations = []
+        self.rates = []
+
+        for n, (incount, t, rate) in enumerate(copies):
+            if n == 0:
+                # Move the item if need be. Items are never moved left.
+                if t > self.pos:
+                    RPR_SetMediaItemInfo_Value(self.iid, "D_POSITION", t)
+                    dbg('Item moved to {}'.format(t))
+                dest = max(t, self.pos)
+            else:
+                # Compute the offset for duplication. It keeps the spacing
+                # in the layout, wherever the copy before ended up.
+                nudge = t - copies[n - 1][1]
+                dest = self.destinations[-1] + nudge
+
+                # Duplicate the item using ApplyNudge and the flags
+                # assigned below. See API doc for more info about args
+                # to ApplyNudge().
+                fbyvalue = 0
+                fduplicate = 5
+                fseconds = 1
+                freverse = False
+                RPR_ApplyNudge(self.proj, fbyvalue, fduplicate, fseconds,
+                               nudge, freverse, 1)
+
+                dbg("Item duped offset by {}".format(nudge))
 
-        # Apppend the requested number of duplicates.
-        for _ in range(ndups):
             # Insert a tempo time at start of incount measure.
-            incountsigd[t] = (TempoTimeSigMarkerWrapper(self.proj, None,
-                timepos = t,
-                bpm = insig.bpm,
+            incount += dest - t
+            incountsigd[incount] = (TempoTimeSigMarkerWrapper(self.proj, None,
+                timepos = incount,
+                bpm = insig.bpm * rate,
                 num = insig.timesig_num,
                 denom = insig.timesig_denom))
 
-            dbg("incount marker position = {}".format(t))
+            dbg("incount marker position = {}".format(incount))
 
-            # Advance to beginning of new item position.
-            t += betweentime + self.intime
+            if scaled:
+                # The new duplicate is the selected item.
+                copyref = (self.iid if n == 0 else
+                           RPR_GetSelectedMediaItem(self.proj, 0))
+                self.setRate(copyref, itemlength, playrate, rate)
 
-            # Clone the tempo time sigs
+            # copy the tempo time markers to the new location, scaling
+            # their offsets and tempi by the rate.
             for sig in itemsigs:
-                newpos = t
-                incountsigd[t] = sig.clone(newpos - self.pos, deferred=True)
-
-            # Compute the offset for duplication
-            nudge = self.length 
-            nudge += self.outtime
-            nudge += betweentime
-            nudge += self.intime
-
-            # Duplicate the item using ApplyNudge and the flags
-            # assigned below. See API doc for more info about args
-            # to ApplyNudge().
-            fbyvalue = 0
-            fduplicate = 5
-            fseconds = 1
-            freverse = False
-            RPR_ApplyNudge(self.proj, fbyvalue, fduplicate, fseconds,
-                           nudge, freverse, 1)
-            
-            dbg("Item duped offset by {}".format(nudge))
-
-            # Advance to end of last measure in item
-            t += self.length + self.outtime
+                newpos = dest + (sig.timepos - self.pos) / rate
+                cloned = sig.clone(newpos, is_offset=False, deferred=True)
+                cloned.bpm = sig.bpm * rate
+                incountsigd[cloned.timepos] = cloned
+
+            self.destinations.append(dest)
+            self.rates.append(rate)
 
         dbg("")  # blank line in console log
 
         # Unselect the item
         RPR_SetMediaItemSelected(self.iid, False)
 
-        # Return end time for last dup so we can use it as
-        # the start of the next item to be processed.
-        return t, incountsigd
+        return incountsigd
+
+    def setRate(self, itemref, length, playrate, rate):
+        """
+        Make the copy itemref play at rate times the original tempo, keeping
+        its pitch.  length and playrate are the original item length and
+        take playrate.
+        """
+        RPR_SetMediaItemInfo_Value(itemref, "D_LENGTH", length / rate)
+        take = RPR_GetActiveTake(itemref)
+        if take:
+            RPR_SetMediaItemTakeInfo_Value(take, "D_PLAYRATE", playrate * rate)
+            RPR_SetMediaItemTakeInfo_Value(take, "B_PPITCH", 1)
+        dbg("Copy at {} rate set to {}".format(
+            RPR_GetMediaItemInfo_Value(itemref, "D_POSITION"), rate))
+
+class TrackEnvelopeReplicator(object):
+    """
+    Snapshot of the automation envelopes (volume, pan, FX parameters ...) of
+    one track, taken before any items are moved.  After the items have been
+    replicated, replicate() rewrites each envelope so that the original and
+    every duplicate carries the points that were under the item in its source
+    position.
+
+    Points are inserted unsorted and each envelope is sorted once at the end,
+    so the cost grows with the number of points written rather than with a
+    re-sort after every insert.
+    """
+    def __init__(self, proj, track, items):
+        """
+        args:
+            - track is the Reaper MediaTrack reference holding the items.
+            - items is the list of MediaItemReplicators for ALL items in the
+              track. Their destinations are read when replicate() is called.
+        """
+        self.proj = proj
+        self.track = track
+        self.items = items
+
+        '''
+        For each envelope keep its index in the track, the reference, a time
+        sorted list of its points as (time, value, shape, tension) tuples and
+        the envelope values at the start and end of every item.  The boundary
+        values must be evaluated now, while the envelope is still intact.
+        '''
+        self.envelopes = []
+        nenv = RPR_CountTrackEnvelopes(track)
+        for envidx in range(nenv):
+            env = RPR_GetTrackEnvelope(track, envidx)
+            points = []
+            for ptidx in range(RPR_CountEnvelopePoints(env)):
+                retlist = RPR_GetEnvelopePoint(env, ptidx, 0.0, 0.0, 0, 0.0,
+                                               False)
+                points.append((retlist[3], retlist[4], retlist[5], retlist[6]))
+            if not points:
+                continue
+            points.sort()
+            edges = [(self.valueAt(env, item.pos),
+                      self.valueAt(env, item.pos + item.length))
+                     for item in items]
+            self.envelopes.append((envidx, env, points, edges))
+
+        dbg("{} track envelopes with points".format(len(self.envelopes)))
+
+    def valueAt(self, env, t):
+        """ Return the value of envelope env at time t. """
+        retlist = RPR_Envelope_Evaluate(env, t, 48000, 1, 0.0, 0.0, 0.0, 0.0)
+        return retlist[5]
+
+    def replicate(self):
+        """
+        Copy each item's time window of envelope points to the original's new
+        position and to every duplicate, spread out or squeezed to match the
+        copy's playback rate.  Points in the gap before an item are shifted
+        along with the item's original, and points after the last item along
+        with its last copy. Points before the first item are unchanged.
+
+        For each envelope rewritten, self.rewritten gets an (envidx, start,
+        end, points) tuple, where points are the original points deleted from
+        the range start to end.
+        """
+        self.rewritten = []
+        items = [item for item in self.items if item.destinations]
+        if not items:
+            return
+        firstpos = min(item.pos for item in items)
+        last = max(items, key=lambda item: item.pos)
+        tailstart = last.pos + last.length
+        tailoffset = (last.destinations[-1] + last.length / last.rates[-1] -
+                      tailstart)
+
+        for envidx, env, points, edges in self.envelopes:
+            times = [p[0] for p in points]
+            newpoints = []
+            gapstart = firstpos
+            for item, (startval, endval) in sorted(zip(self.items, edges),
+                                                   key=lambda ie: ie[0].pos):
+                if not item.destinations:
+                    continue
+                '''
+                Points in the gap since the previous item keep their distance
+                to this item's original.
+                '''
+                gapoffset = item.destinations[0] - item.pos
+                gap = points[bisect_left(times, gapstart):
+                             bisect_left(times, item.pos)]
+                for (pt, val, shp, ten) in gap:
+                    newpoints.append((pt + gapoffset, val, shp, ten))
+                gapstart = max(gapstart, item.pos + item.length)
+
+                lo = bisect_left(times, item.pos)
+                hi = bisect_left(times, item.pos + item.length)
+                window = points[lo:hi]
+                '''
+                Bracket every copy with points holding the envelope value at
+                the item edges. The leading point continues the shape of the
+                segment it was cut from; the trailing one holds its value
+                through the silence that follows.
+                '''
+                if lo > 0:
+                    shape, tension = points[lo - 1][2], points[lo - 1][3]
+                else:
+                    shape, tension = 0, 0.0
+                needstart = not window or window[0][0] > item.pos
+                for dest, rate in zip(item.destinations, item.rates):
+                    if needstart:
+                        newpoints.append((dest, startval, shape, tension))
+                    for (pt, val, shp, ten) in window:
+                        newpoints.append((dest + (pt - item.pos) / rate, val,
+                                          shp, ten))
+                    newpoints.append((dest + item.length / rate, endval, 1,
+                                      0.0))
+
+            for (pt, val, shp, ten) in points[bisect_left(times, tailstart):]:
+                newpoints.append((pt + tailoffset, val, shp, ten))
+
+            end = max([times[-1]] + [p[0] for p in newpoints]) + 1.0
+            RPR_DeleteEnvelopePointRange(env, firstpos, end)
+            self.rewritten.append((envidx, firstpos, end,
+                                   points[bisect_left(times, firstpos):]))
+            for (pt, val, shp, ten) in newpoints:
+                RPR_InsertEnvelopePoint(env, pt, val, shp, ten, False, True)
+            RPR_Envelope_SortPoints(env)
+            dbg("Wrote {} envelope points".format(len(newpoints)))
+
+class ProjectMarkerReplicator(object):
+    """
+    Reads all project markers and regions once, before any items are moved,
+    into a list sorted by position.  After the items have been replicated,
+    replicate() moves the markers inside each item along with it and adds a
+    copy of them to every duplicate.  The markers between and after the items
+    move with their neighbours.
+
+    Markers inside an item are found by binary search on the sorted
+    positions, so per-item lookups don't rescan the full marker list.
+    """
+    def __init__(self, proj, items):
+        """
+        args:
+            - items is the list of MediaItemReplicators for ALL items in the
+              track. Their destinations are read when replicate() is called.
+        """
+        self.proj = proj
+        self.items = items
+
+        '''
+        Each marker is kept as a tuple of
+        (pos, isrgn, rgnend, name, markrgnindexnumber, color).
+        '''
+        self.markers = []
+        retlist = RPR_CountProjectMarkers(proj, 0, 0)
+        for idx in range(retlist[0]):
+            retlist = RPR_EnumProjectMarkers3(proj, idx, False, 0.0, 0.0, "",
+                                              0, 0)
+            self.markers.append((retlist[4], bool(retlist[3]), retlist[5],
+                                 retlist[6], retlist[7], retlist[8]))
+        self.markers.sort()
+        self.positions = [m[0] for m in self.markers]
+        dbg("{} markers and regions in project".format(len(self.markers)))
+
+    def markersIn(self, start, end):
+        """
+        Return the markers and regions beginning at or after start and before
+        end.
+        """
+        lo = bisect_left(self.positions, start)
+        hi = bisect_left(self.positions, end)
+        return self.markers[lo:hi]
+
+    def relocate(self, items, starts, t, end=False):
+        """
+        Return the new time position for time t in the track as it was.
+
+        args:
+            - items are the replicated MediaItemReplicators sorted by
+              position and starts their positions.
+            - end is True when t is the end of a region.  A t inside an item
+              maps into the item's original, or into its last copy when end
+              is True.  A t in the gap before an item keeps its distance to
+              the item's original, and a t after the last item its distance
+              to the last copy.  A t before the first item is unchanged.
+        """
+        if end:
+            i = bisect_left(starts, t) - 1
+        else:
+            i = bisect_right(starts, t) - 1
+        if i < 0:
+            return t
+        item = items[i]
+        offset = t - item.pos
+        '''
+        Allow for items shortened to end just before a barline.  See
+        MediaItemReplicator.__init__().
+        '''
+        if offset < item.length or (end and offset <= item.length + .002):
+            n = -1 if end else 0
+            return item.destinations[n] + offset / item.rates[n]
+        if i + 1 < len(items):
+            following = items[i + 1]
+            return t + following.destinations[0] - following.pos
+        return (t + item.destinations[-1] + item.length / item.rates[-1] -
+                (item.pos + item.length))
+
+    def replicate(self):
+        """
+        Move the markers and regions that begin inside each item to the
+        item's new position and copy them to every duplicate, with their
+        offsets scaled by the copy's playback rate.  A region that runs past
+        the end of the item it begins in isn't copied.  It's stretched from
+        the original of that item to the last copy of the item where it ends,
+        so it still spans the same items.  Markers and regions in the gaps
+        between items move with the item that follows them, and those after
+        the last item with its last copy.  Markers before the first item are
+        left alone.
+
+        The moved markers keep their numbers. The copies are numbered by
+        Reaper.  The markers deleted are left in self.deleted and the
+        (number, isrgn) of those created in self.created.
+        """
+        self.deleted = []
+        self.created = []
+        items = sorted([item for item in self.items if item.destinations],
+                       key=lambda item: item.pos)
+        if not items or not self.markers:
+            return
+        starts = [item.pos for item in items]
+
+        relocated = []
+        for marker in self.markersIn(starts[0], float('inf')):
+            self.deleted.append(marker)
+            pos, isrgn, rgnend, name, number, color = marker
+            item = items[bisect_right(starts, pos) - 1]
+            if (pos < item.pos + item.length and
+                    (not isrgn or rgnend <= item.pos + item.length + .002)):
+                for n, (dest, rate) in enumerate(zip(item.destinations,
+                                                     item.rates)):
+                    relocated.append((isrgn, dest + (pos - item.pos) / rate,
+                                      dest + (rgnend - item.pos) / rate,
+                                      name, number if n == 0 else -1, color))
+            else:
+                newpos = self.relocate(items, starts, pos)
+                if isrgn:
+                    newend = self.relocate(items, starts, rgnend, end=True)
+                else:
+                    newend = newpos
+                relocated.append((isrgn, newpos, newend, name, number, color))
+
+        '''
+        Delete all the markers we're about to rewrite before adding any, and
+        add the moved ones before the copies, so the moved ones can keep
+        their numbers.
+        '''
+        for (_, isrgn, _, _, number, _) in self.deleted:
+            RPR_DeleteProjectMarker(self.proj, number, isrgn)
+        relocated.sort(key=lambda marker: marker[4] < 0)
+        for (isrgn, pos, rgnend, name, number, color) in relocated:
+            number = RPR_AddProjectMarker2(self.proj, isrgn, pos, rgnend, name,
+                                           number, color)
+            self.created.append((number, isrgn))
+        dbg("Wrote {} markers and regions".format(len(relocated)))
+
+class RegionPlaylistBuilder(object):
+    """
+    Zero-copy alternative to replicating the items.  The audio stays where it
+    is. Instead, each item gets a region and the count-ins get regions in a
+    silent stretch after the end of the project, where tempo time sig markers
+    make the metronome count in at the item's tempo and meter.  The playlist
+    lists the regions in the order A A B B C C ... would be played, each
+    segment preceded by its count-in.
+
+    Count-ins with the same tempo, meter and timing share one region, so
+    repeats add nothing to the project.
+
+    Usage:
+        builder = RegionPlaylistBuilder(proj)
+        playlist = builder.build(items, ndups, nbetween)
+    """
+    def __init__(self, proj):
+        self.proj = proj
+
+        '''
+        Time position where the next count-in region can go.  Leave a gap
+        after the end of the project.
+        '''
+        self.t = RPR_GetProjectLength(proj) + 1.0
+
+        '''
+        Count-in regions already created, as (number, name) with a key
+        describing their timing.  See countIn().
+        '''
+        self.countins = {}
+
+        '''
+        Everything created, for the change journal: (number, isrgn) of each
+        region and the time position of each tempo time sig marker.
+        '''
+        self.createdregions = []
+        self.createdsigs = []
+
+    def addRegion(self, start, end, name):
+        """ Create a region and return its (number, name, start, end). """
+        number = RPR_AddProjectMarker2(self.proj, True, start, end, name, -1, 0)
+        self.createdregions.append((number, True))
+        return (number, name, start, end)
+
+    def addSig(self, t, sig):
+        """ Create a tempo time sig marker at t like sig. """
+        TempoTimeSigMarkerWrapper(self.proj, -1, timepos=t, bpm=sig.bpm,
+                                  num=sig.timesig_num,
+                                  denom=sig.timesig_denom)
+        self.createdsigs.append(t)
+
+    def countIn(self, previous, item, insig, leadin):
+        """
+        Return the count-in region to play before a copy of item, creating
+        it if need be, or None if there's no time to count in.
+
+        args:
+            - previous is an (item, outsig) tuple for the item played just
+              before, or None.  The count-in starts with the rest of the bar
+              in which that item ends, its outtime.
+            - insig is the tempo time sig in effect at the start of item.
+            - leadin is the betweentime + intime before item.
+        """
+        if previous is not None and previous[0].outtime > .001:
+            prev, outsig = previous
+            tailkey = (outsig.bpm, outsig.timesig_num, outsig.timesig_denom,
+                       round(prev.endbeats, 4), round(prev.outtime, 4))
+        else:
+            prev = None
+            tailkey = None
+        key = (tailkey, insig.bpm, insig.timesig_num, insig.timesig_denom,
+               round(leadin, 4))
+        if key in self.countins:
+            return self.countins[key]
+        if prev is None and leadin < .001:
+            return None
+
+        t = self.t
+        start = t
+        if prev is not None:
+            '''
+            Start the bar early so the silence begins where prev ended in
+            its bar.
+            '''
+            self.addSig(t, outsig)
+            start = t + prev.endbeats * 60./prev.endbpm
+            t = start + prev.outtime
+        self.addSig(t, insig)
+        end = t + leadin
+
+        name = "Count-in {}".format(len(self.countins) + 1)
+        self.countins[key] = self.addRegion(start, end, name)
+        self.t = end + 1.0
+        return self.countins[key]
+
+    def build(self, items, ndups, nbetween):
+        """
+        Create the regions for items and return the playlist, a list of
+        (number, name, start, end) region tuples in play order.  ndups and
+        nbetween are dictionaries with the values for each item keyed by
+        item.iid.  The playlist is also saved in the project's ext state as
+        one "number,start,end,name" line per entry under
+        ("PracticeTrack", "playlist").
+        """
+        playlist = []
+        previous = None
+        for n, item in enumerate(sorted(items, key=lambda item: item.pos)):
+            insig, outsig, _ = item.findSigs()
+            leadin = item.countInTime(nbetween[item.iid])
+            segment = self.addRegion(item.pos, item.pos + item.length,
+                                     "Segment {}".format(n + 1))
+            for _ in range(1 + ndups[item.iid]):
+                countin = self.countIn(previous, item, insig, leadin)
+                if countin is not None:
+                    playlist.append(countin)
+                playlist.append(segment)
+                previous = (item, outsig)
+
+        text = "\n".join("{},{},{},{}".format(number, start, end, name)
+                         for (number, name, start, end) in playlist)
+        RPR_SetProjExtState(self.proj, "PracticeTrack", "playlist", text)
+        dbg("Playlist:\n{}".format(text))
+        return playlist
+
+class ChangeJournal(object):
+    """
+    A compact record of what one run() changed: the original item
+    positions, lengths and playrates, the duplicates created, the tempo time
+    sig markers deleted and created, the project markers and regions deleted
+    and created and the envelope points rewritten.  revert() replays it in
+    reverse in one batch.
+    The run's segment map is kept with it.  See writeSegmentMap().  For a
+    playlist run, so is the playlist ext state it replaced.
+
+    Journals are kept in JOURNAL_FILENAME in the project directory as a
+    JSON list, oldest run first, so repeated runs can be reverted one at a
+    time.  Items and tracks are identified by their Reaper references, which
+    are only valid until the project is closed.  So each journal also
+    records the session it was made in, see sessionId(), and journals from
+    other sessions are dropped when the file is read.  At most JOURNAL_DEPTH
+    journals are kept.
+    """
+    def __init__(self, proj, record=None):
+        self.proj = proj
+        self.record = record or {
+            "session" : ChangeJournal.sessionId(proj),
+            "track" : None,         # [track index, track reference]
+            "items" : [],           # [reference, position, length, playrate,
+                                    #  preserve pitch]
+            "duplicates" : [],      # reference
+            "sigsdeleted" : [],     # [timepos, bpm, num, denom, lineartempo]
+            "sigscreated" : [],     # timepos
+            "markersdeleted" : [],  # [pos, isrgn, rgnend, name, number, color]
+            "markerscreated" : [],  # [number, isrgn]
+            "envelopes" : [],       # [envidx, start, end, points]
+            "segments" : None,      # Segment rows, None for playlist runs
+            "extstate" : [],        # [section, key, previous value]
+            }
+
+    def recordItems(self, track, items):
+        """
+        Remember track and the original position, length and take playrate
+        of each item in it.
+        """
+        trackidx = int(RPR_GetMediaTrackInfo_Value(track, "IP_TRACKNUMBER")) - 1
+        self.record["track"] = [trackidx, track]
+        for item in items:
+            take = RPR_GetActiveTake(item.iid)
+            if take:
+                playrate = RPR_GetMediaItemTakeInfo_Value(take, "D_PLAYRATE")
+                ppitch = RPR_GetMediaItemTakeInfo_Value(take, "B_PPITCH")
+            else:
+                playrate = ppitch = None
+            self.record["items"].append([item.iid, item.pos,
+                RPR_GetMediaItemInfo_Value(item.iid, "D_LENGTH"), playrate,
+                ppitch])
+
+    def recordDuplicates(self, track):
+        """
+        Remember the items in track that aren't originals, i.e. the
+        duplicates.  Call after all items have been replicated.
+        """
+        originals = set(entry[0] for entry in self.record["items"])
+        for titemid in range(RPR_CountTrackMediaItems(track)):
+            itemref = RPR_GetTrackMediaItem(track, titemid)
+            if itemref not in originals:
+                self.record["duplicates"].append(itemref)
+
+    def recordSigs(self, deleted, created):
+        """
+        Remember the TempoTimeSigMarkerWrappers deleted and the time positions
+        of the markers created.
+        """
+        self.record["sigsdeleted"] += [[sig.timepos, sig.bpm, sig.timesig_num,
+                                        sig.timesig_denom, sig.lineartempo]
+                                       for sig in deleted]
+        self.record["sigscreated"] += list(created)
+
+    def recordMarkers(self, deleted, created):
+        """
+        Remember the project markers and regions deleted, as tuples like
+        those in ProjectMarkerReplicator.markers, and the (number, isrgn) of
+        those created.
+        """
+        self.record["markersdeleted"] += [list(m) for m in deleted]
+        self.record["markerscreated"] += [list(m) for m in created]
+
+    def recordEnvelopes(self, rewritten):
+        """
+        Remember the envelope ranges rewritten, as in
+        TrackEnvelopeReplicator.rewritten.
+        """
+        for (envidx, start, end, points) in rewritten:
+            self.record["envelopes"].append([envidx, start, end,
+                                             [list(p) for p in points]])
+
+    def recordExtState(self, section, key):
+        """
+        Remember the value of the project ext state section/key before it's
+        changed.  An empty value means there was none.
+        """
+        value = RPR_GetProjExtState(self.proj, section, key, "", 65536)[4]
+        self.record["extstate"].append([section, key, value])
+
+    def recordSegments(self, segments):
+        """ Remember the PTKsegmap.Segments of the practice track. """
+        self.record["segments"] = [seg.row() for seg in segments]
+
+    def undoflags(self):
+        """
+        Return the undo state flags covering the changes recorded.  Tempo
+        time sig markers live in the master track's tempo envelope, so they
+        need UNDO_STATE_TRACKCFG just as the track envelopes do.
+        """
+        record = self.record
+        flags = UNDO_STATE_MISCCFG
+        if record["items"]:
+            flags |= UNDO_STATE_ITEMS
+        if (record["envelopes"] or record["sigsdeleted"] or
+                record["sigscreated"]):
+            flags |= UNDO_STATE_TRACKCFG
+        return flags
+
+    def save(self):
+        """ Append this journal to the journal file. """
+        journals = ChangeJournal.loadAll(self.proj)
+        journals.append(self)
+        ChangeJournal.saveAll(self.proj, journals)
+
+    @staticmethod
+    def sessionId(proj):
+        """
+        Return a string identifying proj for as long as it stays open: the
+        Reaper process id and the project's reference.
+        """
+        if not proj:
+            proj = RPR_EnumProjects(-1, "", 0)[0]
+        return "{}:{}".format(os.getpid(), proj)
+
+    @staticmethod
+    def loadAll(proj):
+        """
+        Return a list of the journals in the journal file made since proj was
+        opened, oldest first.
+        """
+        path = projectFile(JOURNAL_FILENAME)
+        if not os.path.exists(path):
+            return []
+        with open(path) as fp:
+            records = json.load(fp)
+        session = ChangeJournal.sessionId(proj)
+        journals = [ChangeJournal(proj, record) for record in records
+                    if record.get("session") == session]
+        if len(journals) < len(records):
+            dbg("Dropped {} journals from earlier sessions".format(
+                len(records) - len(journals)))
+        return journals
+
+    @staticmethod
+    def saveAll(proj, journals):
+        """
+        Replace the contents of the journal file with the last JOURNAL_DEPTH
+        of journals.
+        """
+        records = [journal.record for journal in journals[-JOURNAL_DEPTH:]]
+        with open(projectFile(JOURNAL_FILENAME), 'w') as fp:
+            json.dump(records, fp)
+
+    def revert(self):
+        """
+        Put back everything recorded.  Nothing is changed unless the track
+        and all recorded items are still in the project.
+
+        returns:
+            - a list of strings, one per problem found. Empty when the
+              journal was replayed.
+        """
+        proj = self.proj
+        record = self.record
+        track = None
+        itemrefs = []
+        if record["track"] is not None:
+            trackidx, trackref = record["track"]
+            if (trackidx >= RPR_CountTracks(proj) or
+                    RPR_GetTrack(proj, trackidx) != trackref):
+                return ["Track {} has changed since the run.".format(
+                        trackidx + 1)]
+            track = RPR_GetTrack(proj, trackidx)
+            itemrefs = [RPR_GetTrackMediaItem(track, titemid)
+                        for titemid in range(RPR_CountTrackMediaItems(track))]
+            missing = (set(entry[0] for entry in record["items"]) |
+                       set(record["duplicates"])) - set(itemrefs)
+            if missing:
+                return ["{} items in track {} have been deleted or the project "
+                        "has been reloaded since the run.".format(
+                        len(missing), trackidx + 1)]
+
+        RPR_PreventUIRefresh(1)
+
+        created = sorted(record["sigscreated"])
+        for ptidx in reversed(range(RPR_CountTempoTimeSigMarkers(proj))):
+            sig = TempoTimeSigMarkerWrapper(proj, ptidx)
+            i = bisect_left(created, sig.timepos - 1e-6)
+            if i < len(created) and created[i] <= sig.timepos + 1e-6:
+                sig.remove()
+        for (timepos, bpm, num, denom, linear) in record["sigsdeleted"]:
+            sig = TempoTimeSigMarkerWrapper(proj, None, timepos, bpm, num, denom)
+            sig.lineartempo = linear
+            sig.create()
+
+        for (number, isrgn) in record["markerscreated"]:
+            RPR_DeleteProjectMarker(proj, number, isrgn)
+        for (pos, isrgn, rgnend, name, number, color) in record["markersdeleted"]:
+            if not isinstance(name, str):
+                name = name.encode("utf-8")
+            RPR_AddProjectMarker2(proj, isrgn, pos, rgnend, name, number, color)
+
+        '''
+        Setting an empty value deletes the key.
+        '''
+        for (section, key, value) in record.get("extstate", []):
+            if not isinstance(value, str):
+                value = value.encode("utf-8")
+            RPR_SetProjExtState(proj, section, key, value)
+
+        for (envidx, start, end, points) in record["envelopes"]:
+            env = RPR_GetTrackEnvelope(track, envidx)
+            RPR_DeleteEnvelopePointRange(env, start, end)
+            for (pt, val, shp, ten) in points:
+                RPR_InsertEnvelopePoint(env, pt, val, shp, ten, False, True)
+            RPR_Envelope_SortPoints(env)
+
+        duplicates = set(record["duplicates"])
+        originals = dict((entry[0], entry[1:]) for entry in record["items"])
+        for itemref in itemrefs:
+            if itemref in duplicates:
+                RPR_DeleteTrackMediaItem(track, itemref)
+            elif itemref in originals:
+                pos, length, playrate, ppitch = originals[itemref]
+                RPR_SetMediaItemInfo_Value(itemref, "D_POSITION", pos)
+                RPR_SetMediaItemInfo_Value(itemref, "D_LENGTH", length)
+                take = RPR_GetActiveTake(itemref)
+                if take and playrate is not None:
+                    RPR_SetMediaItemTakeInfo_Value(take, "D_PLAYRATE",
+                                                   playrate)
+                    RPR_SetMediaItemTakeInfo_Value(take, "B_PPITCH", ppitch)
+
+        RPR_PreventUIRefresh(-1)
+        RPR_UpdateArrange()
+        return []
 
 class RunTimer(object):
     """
@@ -0,0 +1,255 @@
+"""
+Offline export of practice clips for PracticeTrackExport.py, a Python
+ReaScript application for (Reaper 5.1)
+
+Each clip is a count-in of metronome clicks followed by one phrase sliced
+from its source recording.  Nothing in here talks to Reaper.  The source
+files are read through memory maps and the clips are written concurrently
+from a pool of threads, so hundreds of phrases take seconds rather than hours
+of render dialogs.
+
+Only uncompressed PCM .wav sources are supported.
+
+Author: Michael Ellis
+Copyright 2015 Ellis & Grant, Inc.
+License: Open Source (MIT License)
+"""
+from multiprocessing.pool import ThreadPool
+import json, math, mmap, os, struct, wave
+
+'''
+Name of the file listing the clips, written to the output directory.
+'''
+MANIFEST_FILENAME = "manifest.json"
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+'''
+Count-in click sound: a decaying sine burst, higher on the first beat of
+each bar.  Level is relative to full scale.
+'''
+CLICK_SECONDS = 0.03
+CLICK_LEVEL = 0.5
+CLICK_HZ = 1000.
+ACCENT_HZ = 1600.
+
+
+class WavSource(object):
+    """
+    A read-only memory map of the sample data in a PCM .wav file.
+    Slicing frames out of it is safe from several threads at once.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        self.data = None
+        try:
+            self.data = mmap.mmap(self.fp.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            self.readFormat()
+        except Exception:
+            # Don't leave the file open if it can't be used.
+            self.close()
+            raise
+        self.clicks = (self.click(CLICK_HZ), self.click(ACCENT_HZ))
+
+    def readFormat(self):
+        """
+        Read the format and the location of the sample data.  Raises
+        ValueError if the file isn't a PCM .wav file.
+        """
+        path = self.path
+        '''
+        Walk the RIFF chunks to find the format and the sample data.
+        '''
+        if self.data[0:4] != b"RIFF" or self.data[8:12] != b"WAVE":
+            raise ValueError("{} is not a .wav file".format(path))
+        self.dataoffset = None
+        offset = 12
+        while offset + 8 <= len(self.data):
+            chunkid = self.data[offset:offset + 4]
+            chunksize = struct.unpack("<I", self.data[offset + 4:offset + 8])[0]
+            body = offset + 8
+            if chunkid == b"fmt ":
+                (formattag, self.nchannels, self.framerate, _, self.blockalign,
+                 bits) = struct.unpack("<HHIIHH", self.data[body:body + 16])
+                if formattag == WAVE_FORMAT_EXTENSIBLE:
+                    formattag = struct.unpack("<H",
+                                              self.data[body + 24:body + 26])[0]
+                if formattag != WAVE_FORMAT_PCM:
+                    raise ValueError("{} is not PCM (format {})".format(
+                                     path, formattag))
+                self.sampwidth = (bits + 7) // 8
+            elif chunkid == b"data":
+                self.dataoffset = body
+                self.datasize = min(chunksize, len(self.data) - body)
+                break
+            offset = body + chunksize + (chunksize & 1)
+        if self.dataoffset is None:
+            raise ValueError("{} has no sample data".format(path))
+        self.nframes = self.datasize // self.blockalign
+
+    def frames(self, start, length):
+        """
+        Return the sample data for length seconds beginning start seconds
+        into the file, clipped to the data available.
+        """
+        first = max(0, int(round(start * self.framerate)))
+        last = min(self.nframes, first + int(round(length * self.framerate)))
+        if last <= first:
+            return b""
+        return self.data[self.dataoffset + first * self.blockalign:
+                         self.dataoffset + last * self.blockalign]
+
+    def silence(self, length):
+        """ Return sample data for length seconds of silence. """
+        nbytes = int(round(length * self.framerate)) * self.blockalign
+        # 8 bit samples are unsigned, centered on 128.
+        return (b"\x80" if self.sampwidth == 1 else b"\x00") * nbytes
+
+    def encode(self, values):
+        """
+        Return sample data for values, one float from -1.0 to 1.0 per frame,
+        in this file's format, with the same value on every channel.
+        """
+        fullscale = 2 ** (8 * self.sampwidth - 1) - 1
+        padding = b"\x00" * (self.blockalign - self.nchannels * self.sampwidth)
+        frames = []
+        for value in values:
+            sample = int(round(value * fullscale))
+            if self.sampwidth == 1:
+                data = struct.pack("<B", sample + 128)
+            else:
+                data = struct.pack("<i", sample)[:self.sampwidth]
+            frames.append(data * self.nchannels + padding)
+        return b"".join(frames)
+
+    def click(self, hz):
+        """ Return sample data for one count-in click at pitch hz. """
+        nframes = int(CLICK_SECONDS * self.framerate)
+        decay = nframes / 5.
+        return self.encode(
+            CLICK_LEVEL * math.exp(-i / decay) *
+            math.sin(2 * math.pi * hz * i / self.framerate)
+            for i in range(nframes))
+
+    def countIn(self, length, secondsperbeat, beatsperbar):
+        """
+        Return sample data for length seconds of count-in, a click on every
+        beat starting with a bar line, the first beat of each bar accented.
+        """
+        data = bytearray(self.silence(length))
+        beat = 0
+        while beat * secondsperbeat < length - 1e-6:
+            offset = (int(round(beat * secondsperbeat * self.framerate)) *
+                      self.blockalign)
+            sound = self.clicks[beat % beatsperbar == 0]
+            sound = sound[:len(data) - offset]
+            data[offset:offset + len(sound)] = sound
+            beat += 1
+        return bytes(data)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.fp.close()
+
+
+def clipName(clip):
+    """ Return the file name for clip, from its index and bar number. """
+    return "phrase_{:03d}_bar_{:03d}.wav".format(clip["index"], clip["bar"])
+
+
+def writeClip(clip, source, outdir):
+    """
+    Write one clip, countin seconds of count-in then the phrase, and return
+    its manifest entry.  The count-in clicks every secondsperbeat, or is
+    silent if the clip doesn't give its beat timing.
+
+    args:
+        - clip is a dictionary with the keys listed in exportClips().
+        - source is the WavSource for clip["source"].
+    """
+    path = os.path.join(outdir, clipName(clip))
+    out = wave.open(path, 'wb')
+    try:
+        out.setnchannels(source.nchannels)
+        out.setsampwidth(source.sampwidth)
+        out.setframerate(source.framerate)
+        if clip.get("secondsperbeat") and clip.get("beatsperbar"):
+            out.writeframes(source.countIn(clip["countin"],
+                                           clip["secondsperbeat"],
+                                           int(clip["beatsperbar"])))
+        else:
+            out.writeframes(source.silence(clip["countin"]))
+        out.writeframes(source.frames(clip["sourceoffset"], clip["length"]))
+    finally:
+        out.close()
+    entry = dict(clip)
+    entry["file"] = os.path.basename(path)
+    return entry
+
+
+def exportClips(clips, outdir, nthreads=4):
+    """
+    Write all clips to outdir, nthreads at a time, along with a manifest
+    listing their timing.
+
+    args:
+        - clips is a list of dictionaries, one per clip, with at least
+          these keys:
+            index : phrase number, used in the file name.
+            bar : bar number where the phrase starts, used in the file name.
+            source : path of the source .wav file.
+            sourceoffset : where the phrase starts in the source file, in
+                           seconds.
+            length : phrase length in seconds.
+            countin : seconds of count-in before the phrase.
+          and optionally:
+            secondsperbeat, beatsperbar : beat length in seconds and beats
+                                          per bar for the count-in clicks.
+                                          Without them the count-in is
+                                          silent.
+          Any other keys, e.g. tempo and meter, are copied to the manifest.
+    returns:
+        - the manifest, a list of the clip dictionaries in the order given,
+          each with a "file" key added.  Clips whose source can't be read,
+          e.g. an .mp3, are skipped and get a "skipped" key with the reason
+          instead.
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    def write(clip):
+        source = sources[clip["source"]]
+        if isinstance(source, WavSource):
+            return writeClip(clip, source, outdir)
+        entry = dict(clip)
+        entry["skipped"] = str(source)
+        return entry
+
+    '''
+    sources maps each source path to its WavSource, or to the exception
+    raised opening it.
+    '''
+    sources = {}
+    pool = ThreadPool(nthreads)
+    try:
+        for clip in clips:
+            if clip["source"] not in sources:
+                try:
+                    sources[clip["source"]] = WavSource(clip["source"])
+                except (EnvironmentError, ValueError) as e:
+                    sources[clip["source"]] = e
+        manifest = pool.map(write, clips)
+    finally:
+        pool.close()
+        pool.join()
+        for source in sources.values():
+            if isinstance(source, WavSource):
+                source.close()
+
+    with open(os.path.join(outdir, MANIFEST_FILENAME), 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    return manifest
@@ -0,0 +1,240 @@
+"""
+Layout computations for PracticeTrack.py, a Python ReaScript application
+for (Reaper 5.1)
+
+Nothing in here talks to Reaper.  The functions work on plain sequences of
+item measurements so they can be used (and timed) outside of Reaper.
+
+NumPy is used when it's installed in the Python that Reaper runs.  Otherwise
+an equivalent pure Python loop produces the same results.  Run this file,
+outside of Reaper, to check that they do.  See checkLayout().
+
+Author: Michael Ellis
+Copyright 2015 Ellis & Grant, Inc.
+License: Open Source (MIT License)
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class ItemLayout(object):
+    """
+    The positions computed by computeLayout().  All lists have one entry per
+    copy, i.e. 1 + ndups entries per item, in playing order.
+
+        - itemidx : index of the item each copy was made from.
+        - copynum : 0 for the original, 1 ... ndups for the duplicates.
+        - incounts : time position where each copy's count-in begins.
+        - starts : time position where each copy begins.
+        - rates : playback rate of each copy, 1.0 for the original tempo.
+        - firstcopy : one entry per item, index of the item's original in
+                      the lists above.
+        - end : time position just after the last copy's outtime.
+    """
+    def __init__(self, itemidx, copynum, incounts, starts, rates, firstcopy,
+                 end):
+        self.itemidx = itemidx
+        self.copynum = copynum
+        self.incounts = incounts
+        self.starts = starts
+        self.rates = rates
+        self.firstcopy = firstcopy
+        self.end = end
+
+    def copies(self, n):
+        """
+        Return a list of (incount, start, rate) tuples for the copies of
+        item n.
+        """
+        first = self.firstcopy[n]
+        if n + 1 < len(self.firstcopy):
+            last = self.firstcopy[n + 1]
+        else:
+            last = len(self.incounts)
+        return list(zip(self.incounts[first:last], self.starts[first:last],
+                        self.rates[first:last]))
+
+
+def computeLayout(lengths, leadins, outtimes, ndups, t0=0.0, rates=(1.0,),
+                  ramped=None, positions=None):
+    """
+    Compute where every original, duplicate and count-in goes.
+
+    Each copy of an item occupies
+
+        leadin + length + outtime
+
+    seconds, where leadin is the count-in: nbetween bars at the tempo and
+    meter at the start of the item, then intime.  An item with ndups
+    duplicates occupies 1 + ndups times that much, so the whole layout is a
+    prefix sum over the copies.
+
+    A copy played at rate r, e.g. 0.7 for 70% of the original tempo, takes
+    1/r times as long, count-in included.
+
+    Items are never moved left.  If positions are given, an item whose
+    original would start before its current position stays there, leaving a
+    gap, and everything after it follows on from there.
+
+    args:
+        - lengths, leadins, outtimes : per item, in seconds.
+        - ndups : number of duplicates, either one value for all items or a
+                  sequence with one value per item.
+        - t0 : time position of the first count-in.
+        - rates : playback rate for the original and each duplicate in turn.
+                  Copies beyond the end of rates use the last value.
+        - ramped : per item, True if rates apply to the item.  Copies of
+                   other items play at 1.0.  Default is all items.
+        - positions : per item, current time position, or None.
+    returns:
+        - an ItemLayout instance.
+    """
+    nitems = len(lengths)
+    if not hasattr(ndups, '__len__'):
+        ndups = [ndups] * nitems
+    if ramped is None:
+        ramped = [True] * nitems
+    if positions is None:
+        positions = [float('-inf')] * nitems
+    if nitems == 0:
+        return ItemLayout([], [], [], [], [], [], t0)
+    if np is not None:
+        return _computeLayoutNumpy(lengths, leadins, outtimes, ndups, t0,
+                                   rates, ramped, positions)
+
+    itemidx = []
+    copynum = []
+    incounts = []
+    starts = []
+    copyrates = []
+    firstcopy = []
+    t = t0
+    for n in range(nitems):
+        leadin = leadins[n]
+        block = leadin + lengths[n] + outtimes[n]
+        firstcopy.append(len(incounts))
+        for k in range(1 + ndups[n]):
+            rate = rates[min(k, len(rates) - 1)] if ramped[n] else 1.0
+            if k == 0:
+                t = max(t, positions[n] - leadin / rate)
+            itemidx.append(n)
+            copynum.append(k)
+            incounts.append(t)
+            starts.append(t + leadin / rate)
+            copyrates.append(rate)
+            t += block / rate
+    return ItemLayout(itemidx, copynum, incounts, starts, copyrates, firstcopy,
+                      t)
+
+
+def _computeLayoutNumpy(lengths, leadins, outtimes, ndups, t0, rates, ramped,
+                        positions):
+    """ Vectorized body of computeLayout(). Same args and return value. """
+    lengths = np.asarray(lengths, dtype=float)
+    leadins = np.asarray(leadins, dtype=float)
+    outtimes = np.asarray(outtimes, dtype=float)
+    ndups = np.asarray(ndups, dtype=int)
+    rates = np.asarray(rates, dtype=float)
+    ramped = np.asarray(ramped, dtype=bool)
+    positions = np.asarray(positions, dtype=float)
+
+    blocks = leadins + lengths + outtimes
+
+    ncopies = 1 + ndups
+    ends = np.cumsum(ncopies)
+    firstcopy = ends - ncopies
+    itemidx = np.repeat(np.arange(len(lengths)), ncopies)
+    copynum = np.arange(ends[-1]) - firstcopy[itemidx]
+
+    copyrates = np.where(ramped[itemidx],
+                         rates[np.minimum(copynum, len(rates) - 1)], 1.0)
+    copyblocks = blocks[itemidx] / copyrates
+    copyleadins = leadins[itemidx] / copyrates
+
+    '''
+    Each incount is the end of the copy before it, but no earlier than the
+    floor set by t0 or the item's position.  With before[c] the total length
+    of the copies before copy c, that's
+        incounts[c] = before[c] + max(floors[j] - before[j] for j <= c)
+    a running maximum.
+    '''
+    before = np.concatenate(([0.], np.cumsum(copyblocks)[:-1]))
+    floors = np.full(len(copyblocks), -np.inf)
+    floors[firstcopy] = positions - copyleadins[firstcopy]
+    floors[0] = max(floors[0], t0)
+    incounts = before + np.maximum.accumulate(floors - before)
+    copyends = incounts + copyblocks
+    starts = incounts + copyleadins
+
+    return ItemLayout(itemidx.tolist(), copynum.tolist(), incounts.tolist(),
+                      starts.tolist(), copyrates.tolist(), firstcopy.tolist(),
+                      float(copyends[-1]))
+
+
+def checkLayout(trials=300, maxitems=200, seed=1):
+    """
+    Check that the NumPy and pure Python layouts agree on random items, with
+    and without ramps and position floors, then time both on 100000 items.
+    Raises AssertionError at the first difference.  Needs NumPy, but not
+    Reaper.  Run this file to call it.
+    """
+    import random, time
+    if np is None:
+        raise ImportError("NumPy isn't installed. Nothing to compare.")
+    numpy = np
+    rng = random.Random(seed)
+
+    def randomItems(nitems):
+        lengths = [rng.uniform(0.5, 20.) for _ in range(nitems)]
+        leadins = [rng.uniform(0., 8.) for _ in range(nitems)]
+        outtimes = [rng.uniform(0., 3.) for _ in range(nitems)]
+        ndups = [rng.randint(0, 4) for _ in range(nitems)]
+        kwargs = dict(t0=rng.choice([0., 1.5]),
+                      rates=rng.choice([(1.0,), (0.7, 0.85, 1.0)]),
+                      ramped=[rng.random() < .8 for _ in range(nitems)])
+        if rng.random() < .5:
+            positions = []
+            t = 0.
+            for length in lengths:
+                t += rng.choice([0., 0., 0., 100.])
+                positions.append(t)
+                t += length
+            kwargs["positions"] = positions
+        return (lengths, leadins, outtimes, ndups), kwargs
+
+    def layout(usenumpy, args, kwargs):
+        global np
+        np = numpy if usenumpy else None
+        try:
+            return computeLayout(*args, **kwargs)
+        finally:
+            np = numpy
+
+    def close(a, b):
+        return abs(a - b) <= 1e-9 * max(1., abs(a), abs(b))
+
+    for trial in range(trials):
+        args, kwargs = randomItems(rng.randint(1, maxitems))
+        fast = layout(True, args, kwargs)
+        slow = layout(False, args, kwargs)
+        for name in ("itemidx", "copynum", "firstcopy"):
+            assert getattr(fast, name) == getattr(slow, name), (trial, name)
+        for name in ("incounts", "starts", "rates"):
+            assert all(close(a, b) for a, b in zip(getattr(fast, name),
+                                                   getattr(slow, name))), \
+                (trial, name)
+        assert close(fast.end, slow.end), (trial, "end")
+    print("{} random layouts agree.".format(trials))
+
+    args, kwargs = randomItems(100000)
+    for label, usenumpy in (("NumPy", True), ("Python", False)):
+        start = time.time()
+        layout(usenumpy, args, kwargs)
+        print("{}: 100000 items in {:.3f}s".format(label,
+                                                  time.time() - start))
+
+
+if __name__ == "__main__":
+    checkLayout()
@@ -0,0 +1,119 @@
+"""
+Mapping between practice track time and source recording time, written by
+PracticeTrack.py, a Python ReaScript application for (Reaper 5.1)
+
+Nothing in here talks to Reaper, so score following, lyric display and other
+tools can load the map written by run() and use it while playback runs.
+
+Usage example:
+    segmap = SegmentMap.load("/path/to/project/PracticeTrack.segments")
+    segmap.toSource(93.2)        # => (41.7, segment) or None in a count-in
+    segmap.toPractice(41.7)      # => [(12.3, segment), (93.2, segment)]
+
+Both lookups are binary searches, O(log n) in the number of segments.
+
+Author: Michael Ellis
+Copyright 2015 Ellis & Grant, Inc.
+License: Open Source (MIT License)
+"""
+from bisect import bisect_right
+import json
+
+
+class Segment(object):
+    """
+    One original, or duplicate, of an item as placed in the practice track.
+
+        - start, end : time span in the practice track.
+        - sourcestart, sourceend : time span in the source recording.
+        - copynum : 0 for the original, 1 ... ndups for the duplicates.
+        - countinstart, countinend : time span of the count-in that precedes
+                                     the segment in the practice track.
+        - rate : playback rate, 1.0 when the copy plays at the original tempo.
+                 One second of practice time covers rate seconds of source.
+    """
+    def __init__(self, start, end, sourcestart, copynum, countinstart,
+                 countinend, rate=1.0):
+        self.start = start
+        self.end = end
+        self.sourcestart = sourcestart
+        self.sourceend = sourcestart + (end - start) * rate
+        self.copynum = copynum
+        self.countinstart = countinstart
+        self.countinend = countinend
+        self.rate = rate
+
+    def row(self):
+        """ Return the list of values the segment was constructed from. """
+        return [self.start, self.end, self.sourcestart, self.copynum,
+                self.countinstart, self.countinend, self.rate]
+
+    def __repr__(self):
+        return "Segment({})".format(", ".join(str(v) for v in self.row()))
+
+
+class SegmentMap(object):
+    """
+    A table of Segments sorted by practice time, with a second ordering by
+    source time, for looking up positions in either direction.
+    """
+    def __init__(self, segments):
+        self.segments = sorted(segments, key=lambda seg: seg.start)
+        self.starts = [seg.start for seg in self.segments]
+
+        '''
+        Segments sorted by source time. The copies of an item share a
+        source span and are kept in copy order.
+        '''
+        self.bysource = sorted(self.segments,
+                               key=lambda seg: (seg.sourcestart, seg.copynum))
+        self.sourcestarts = [seg.sourcestart for seg in self.bysource]
+
+    def toSource(self, t):
+        """
+        Map practice track time t to source time.
+
+        returns:
+            - (source time, segment) or None if t isn't inside a segment,
+              e.g. during a count-in.
+        """
+        i = bisect_right(self.starts, t) - 1
+        if i < 0:
+            return None
+        seg = self.segments[i]
+        if t >= seg.end:
+            return None
+        return seg.sourcestart + (t - seg.start) * seg.rate, seg
+
+    def toPractice(self, t, copynum=None):
+        """
+        Map source time t to practice track time.
+
+        returns:
+            - a list of (practice time, segment), one for each copy of the
+              segment containing t, in copy order.  If copynum is given,
+              only that copy is listed.  Empty if t isn't inside a segment.
+        """
+        i = bisect_right(self.sourcestarts, t) - 1
+        if i < 0:
+            return []
+        sourcestart = self.bysource[i].sourcestart
+        found = []
+        while i >= 0 and self.bysource[i].sourcestart == sourcestart:
+            seg = self.bysource[i]
+            if t < seg.sourceend and copynum in (None, seg.copynum):
+                found.append((seg.start + (t - sourcestart) / seg.rate, seg))
+            i -= 1
+        found.reverse()
+        return found
+
+    def dump(self, path):
+        """ Write the map to path as a JSON list of Segment rows. """
+        with open(path, 'w') as fp:
+            json.dump([seg.row() for seg in self.segments], fp)
+
+    @staticmethod
+    def load(path):
+        """ Return the SegmentMap written to path by dump(). """
+        with open(path) as fp:
+            return SegmentMap([Segment(*row) for row in json.load(fp)])
@@ -7,7 +7,7 @@ License: Open Source (MIT License)
 
 """
 from reaper_python import *
-import sys, os
+import sys, os, re
 def console(obj):
     """ Convenience wrapper for console logging """
     RPR_ShowConsoleMsg("{}\n".format(obj))
@@ -60,6 +60,42 @@ def userInputs(title, **items):
 
         return inputs
                               
+def parseOverrides(text, *names):
+    """
+    Find integer settings written as name=value (or name: value) in text, e.g.
+    an item's notes or take name.  Only the given names are recognized.
+
+    Usage example:
+    parseOverrides("Chorus ndups=4 nbetween=2", "ndups", "nbetween")
+    Returns:
+        - A Map object with an entry for each name found, e.g.
+          {'ndups': 4, 'nbetween': 2}.  Names not found are absent.
+    """
+    found = Map()
+    pattern = r"\b({})\s*[=:]\s*(\d+)".format("|".join(names))
+    for name, value in re.findall(pattern, text or ""):
+        found[name] = int(value)
+    return found
+
+def parseRamp(text):
+    """
+    Convert a list of tempo percentages separated by spaces or slashes, e.g.
+    "70 85 100" or "70/85/100", to a list of playback rates.
+
+    Usage example:
+    parseRamp("70 85 100")
+    Returns:
+        - A list of rates, e.g. [0.7, 0.85, 1.0].
+        - An empty list if text isn't a list of positive numbers.
+    """
+    try:
+        rates = [float(p) / 100. for p in re.split(r"[\s/]+", text.strip())]
+    except ValueError:
+        return []
+    if not all(rate > 0 for rate in rates):
+        return []
+    return rates
+
 class Map(dict):
     """
     Creates a dict-like object with dot notation access.
@@ -31,6 +31,9 @@ Typical Usage:
        details.
 
     2. IMPORTANT! Make sure the timebase is set to 'time' for both items and markers.
+       The script checks this before changing anything.  Items using the project
+       default timebase and the tempo marker timebase are only checked when the
+       SWS extension is installed.
 
     3. Select all the items in the track. (You can also select a contiguous
        group of items extending to the end of the track. This would leave items to
@@ -45,11 +48,26 @@ Typical Usage:
             Fill in an integer values for the number of bars of silence to insert
             between items. The default is '1', any value >= 0 is acceptable.   
 
+            To override these for a single item, write e.g. 'ndups=4' or
+            'nbetween=2' in the item's notes or take name.
+
+            ramp sets the tempo of the original and each duplicate in turn, in
+            percent of the recorded tempo, e.g. '70 85 100' to speed up over
+            the repeats.  The default '100' keeps every copy at full tempo.
+
+            Leave playlist at '0' to move and duplicate the items.  Set it to
+            '1' to leave the audio in place and create a region for each item
+            and count-in instead.  The order in which to play the regions is
+            saved in the project (ext state "PracticeTrack", key "playlist").
+
     6. Click OK. Wait for processing to complete. The processing time depends on the
        number of items in the track and the number of tempo time signature
        changes. Processing hundreds of items might take several minutes.  For
        just a few items, less than a second.  Should something go wrong, 'Edit
-       Undo' will revert your project in one step.
+       Undo' will revert your project in one step, items, tempo map,
+       envelopes, markers and regions alike.  For large projects,
+       PracticeTrackRevert.py does the same much faster by replaying a journal
+       of only the changes that were made.
 
     7. Edit the project as needed to create your practice track.
 
@@ -62,5 +80,5 @@ from PTKmodules.PTKclasses import run
 
         
 RPR_Undo_BeginBlock()
-run()
-RPR_Undo_EndBlock("Script execution", -1)
+flags = run()
+RPR_Undo_EndBlock("Script execution", flags or 0)
@@ -0,0 +1,35 @@
+"""
+Practice Tracks Export, a Python ReaScript (Reaper 5.1)
+Writes each selected media item as a standalone practice clip: the count-in
+bar(s), clicked at the item's tempo and meter, followed by the phrase, named
+by phrase number and bar number.  The clips and a manifest.json listing their
+timing go in the PracticeClips directory in the project directory. The
+project itself is not changed.
+
+Author: Michael Ellis
+Copyright 2015 Ellis & Grant, Inc.
+License: Open Source (MIT License)
+No warranty whatsoever ... etc.
+
+Installation:
+    Same as PracticeTrack.py.
+
+Usage:
+    1. Slice and select the items as for PracticeTrack.py.  Their sources must
+       be uncompressed .wav files.  Items with other sources are skipped and
+       listed as such in the manifest.
+
+    2. Invoke PracticeTrackExport.py (this file) from the Actions menu.
+
+    3. An 'Export' dialog appears.
+            nbetween is the number of bars of count-in before each phrase,
+            as in PracticeTrack.py. Items with their own nbetween setting
+            use that instead.
+
+            nthreads is the number of clips written at the same time.
+"""
+
+from PTKmodules.PTKclasses import exportClipLibrary
+
+
+exportClipLibrary()
@@ -0,0 +1,28 @@
+"""
+Practice Tracks Revert, a Python ReaScript (Reaper 5.1)
+Puts back the project as it was before the most recent run of PracticeTrack.py.
+Only the changes recorded in the run's change journal are replayed, so this is
+much quicker than a whole-project undo for large projects.  Run it again to
+revert earlier runs.
+
+The journal refers to items by their Reaper references, which don't survive
+closing the project.  Runs from before the project was last opened are dropped
+from the journal, as are all runs once one can't be reverted, e.g. because
+its items were deleted.  Use 'Edit Undo' for those instead.  Only the last 20
+runs are kept.
+
+Author: Michael Ellis
+Copyright 2015 Ellis & Grant, Inc.
+License: Open Source (MIT License)
+No warranty whatsoever ... etc.
+
+Installation:
+    Same as PracticeTrack.py.
+"""
+
+from PTKmodules.PTKclasses import revert
+
+
+RPR_Undo_BeginBlock()
+flags = revert()
+RPR_Undo_EndBlock("Revert practice track", flags or 0)